@@ -0,0 +1,391 @@
+#!/bin/env python
+"""
+Benchmarks for old_lol_dl.py against synthetic releases.
+Usage: python bench.py [benchmark ...]
+"""
+import gc
+import hashlib
+import http.server
+import os
+import random
+import re
+import struct
+import sys
+import tempfile
+import threading
+import io
+import time
+import tracemalloc
+import urllib.parse
+import zlib
+from multiprocessing.pool import ThreadPool
+import old_lol_dl as dl
+
+def build_manifest(entries, project: str = 'bench_project', version: str = '0.0.0.1') -> bytes:
+    # entries: iterable of (path, md5 bytes, size_uncompressed, size_compressed)
+    names = []
+    name_ids = {}
+    def name_id(name):
+        if name not in name_ids:
+            name_ids[name] = len(names)
+            names.append(name)
+        return name_ids[name]
+    root = ({}, [])
+    for path, md5, size_uncompressed, size_compressed in entries:
+        node = root
+        *folders, name = path.strip('/').split('/')
+        for folder in folders:
+            node = node[0].setdefault(folder, ({}, []))
+        node[1].append((name, md5, size_uncompressed, size_compressed))
+    # breadth first so every folder's subfolders and files are contiguous
+    # every file is stamped with the release version, so its url lives under that release
+    release = bytes(reversed([ int(x) for x in version.split('.') ]))
+    order = [ ('', root) ]
+    folders = []
+    files = []
+    for name, (subs, leafs) in order:
+        folders.append([ name_id(name), len(order), len(subs), len(files), len(leafs) ])
+        order.extend(subs.items())
+        for leaf, md5, size_uncompressed, size_compressed in leafs:
+            files.append((name_id(leaf), release, md5, 0, size_uncompressed, size_compressed, 0))
+    project_id = name_id(project)
+    out = io.BytesIO()
+    out.write(b'RLSM')
+    out.write(dl.S_HEADER.pack(1, 1, project_id, release))
+    out.write(dl.S_COUNT.pack(len(folders)))
+    for folder in folders:
+        out.write(dl.S_FOLDER.pack(*folder))
+    out.write(dl.S_COUNT.pack(len(files)))
+    for file in files:
+        out.write(dl.S_FILE.pack(*file))
+    name_data = '\0'.join(names).encode('utf-8') + b'\0'
+    out.write(struct.pack('< I I', len(names), len(name_data)))
+    out.write(name_data)
+    return out.getvalue()
+
+class ReleaseHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        data = self.server.files.get(urllib.parse.unquote(self.path))
+        if data is None:
+            self.send_response(404)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        match = re.fullmatch(r'bytes=(\d+)-(\d*)', self.headers.get('Range', ''))
+        if match:
+            start = int(match[1])
+            end = int(match[2]) + 1 if match[2] else len(data)
+            if start >= len(data):
+                self.send_response(416)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            self.send_response(206)
+            self.send_header('Content-Range', f'bytes {start}-{min(end, len(data)) - 1}/{len(data)}')
+            data = data[start:end]
+        else:
+            self.send_response(200)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        if not self.server.rate:
+            self.wfile.write(data)
+            return
+        # per connection throttle, like a cdn edge handing each client a fixed share
+        piece = max(1, self.server.rate // 100)
+        start = time.perf_counter()
+        for offset in range(0, len(data), piece):
+            self.wfile.write(data[offset:offset + piece])
+            delay = start + (offset + piece) / self.server.rate - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+
+    def log_message(self, format, *args):
+        pass
+
+class ReleaseServer(http.server.ThreadingHTTPServer):
+    # local stand-in for the cdn serving a dict of url path -> body over keep-alive http/1.1
+    daemon_threads = True
+    request_queue_size = 1024
+
+    def __init__(self, files: dict, rate: int = None):
+        super().__init__(('127.0.0.1', 0), ReleaseHandler)
+        self.files = files
+        self.rate = rate
+        self.url = f'http://127.0.0.1:{self.server_address[1]}'
+        threading.Thread(target = self.serve_forever, daemon = True).start()
+
+    def handle_error(self, request, client_address):
+        # clients dropping a response they no longer need is expected here
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.shutdown()
+        self.server_close()
+
+def make_release(contents, project: str = 'bench_project', version: str = '0.0.0.1'):
+    # contents: iterable of (path, data), returns the manifest and the files a cdn would serve for it
+    entries = []
+    compressed = {}
+    for path, data in contents:
+        compressed[path] = zlib.compress(data)
+        entries.append((path, hashlib.md5(data).digest(), len(data), len(compressed[path])))
+    manifest = build_manifest(entries, project, version)
+    # served where the downloader will look for them, under the file version written into the manifest
+    man = dl.ManColumns.parse(manifest)
+    files = { urllib.parse.unquote(f'/{man.file_url(file_index)}'): compressed[man.file_path(file_index)] for file_index in man.file_range() }
+    files[f'/projects/{project}/releases/{version}/releasemanifest'] = manifest
+    return manifest, files
+
+def synthetic_entries(file_count: int, seed: int = 0):
+    rng = random.Random(seed)
+    for i in range(0, file_count):
+        depth = rng.randint(1, 5)
+        folders = '/'.join(f'folder{rng.randint(0, 12)}' for _ in range(0, depth))
+        size = int(rng.paretovariate(1.2) * 4096)
+        yield f'/DATA/{folders}/file{i}.bin', hashlib.md5(str(i).encode()).digest(), size, size // 2
+
+def timeit(func, repeat: int = 5) -> float:
+    # like the timeit module: best of repeat with the cyclic gc out of the picture
+    best = None
+    for _ in range(0, repeat):
+        gc.collect()
+        gc.disable()
+        try:
+            start = time.perf_counter()
+            func()
+            elapsed = time.perf_counter() - start
+        finally:
+            gc.enable()
+        best = elapsed if best is None or elapsed < best else best
+    return best
+
+def baseline_read(buffer) -> dl.Man:
+    # the original record by record reader, kept as is as the reference the faster parsers are measured against
+    def read_header(buffer):
+        S_HEADER = struct.Struct('< H H I 4s')
+        return dl.ManHeader(*S_HEADER.unpack_from(buffer.read(S_HEADER.size)))
+    def read_folder(buffer):
+        S_FOLDER = struct.Struct('< I I I I I')
+        return dl.ManFolder(*S_FOLDER.unpack_from(buffer.read(S_FOLDER.size)))
+    def read_file(buffer):
+        S_FILE = struct.Struct('< I 4s 16s I I I Q')
+        return dl.ManFile(*S_FILE.unpack_from(buffer.read(S_FILE.size)))
+    magic = buffer.read(4)
+    assert(magic == b"RLSM")
+    header = read_header(buffer)
+    folder_count = int.from_bytes(buffer.read(4), byteorder='little')
+    folders = [ read_folder(buffer) for _ in range(0, folder_count) ]
+    file_count = int.from_bytes(buffer.read(4), byteorder='little')
+    files = [ read_file(buffer) for _ in range(0, file_count) ]
+    name_count = int.from_bytes(buffer.read(4), byteorder='little')
+    name_data_length = int.from_bytes(buffer.read(4), byteorder='little')
+    names = buffer.read(name_data_length).decode('utf-8').split('\0')
+    folder_parents = [ None ] * folder_count
+    file_parents = [ None ] * file_count
+    for parent, folder in enumerate(folders):
+        for sub in folder.folders():
+            folder_parents[sub] = parent
+        for sub in folder.files():
+            file_parents[sub] = parent
+    return dl.Man(header, folders, folder_parents, files, file_parents, names)
+
+def bench_parse():
+    for file_count in [ 1000, 10000, 50000 ]:
+        data = build_manifest(synthetic_entries(file_count))
+        legacy = timeit(lambda: baseline_read(io.BytesIO(data)))
+        bulk = timeit(lambda: dl.Man.parse(data))
+        columns = timeit(lambda: dl.ManColumns.parse(data))
+        print(f'parse {file_count:>6} files: baseline read {legacy * 1000:8.2f} ms, parse {bulk * 1000:8.2f} ms, {legacy / bulk:5.2f}x'
+              f', columns {columns * 1000:8.2f} ms, {legacy / columns:5.2f}x')
+
+def bench_memory():
+    for file_count in [ 10000, 50000 ]:
+        data = build_manifest(synthetic_entries(file_count))
+        for backend in [ dl.Man, dl.ManColumns ]:
+            tracemalloc.start()
+            man = backend.parse(data)
+            size, _ = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            print(f'memory {file_count:>6} files: {backend.__name__:<10} {size / 1024 / 1024:8.2f} MiB, {size / file_count:7.1f} bytes/file')
+            del man
+
+def bench_lookup():
+    man = dl.ManColumns.parse(build_manifest(synthetic_entries(50000)))
+    paths = [ man.file_path(file_index) for file_index in range(0, man.file_count(), 500) ]
+    scan = timeit(lambda: [ next(i for i in man.file_range() if man.file_path(i) == path) for path in paths ], 1)
+    build = timeit(lambda: (man.__dict__.pop('file_path_index', None), man.file_path_index), 1)
+    lookup = timeit(lambda: [ man.file_lookup(path) for path in paths ])
+    print(f'lookup {len(paths)} paths in {man.file_count()} files: scan {scan * 1000:8.2f} ms'
+          f', index build {build * 1000:8.2f} ms, indexed {lookup * 1000:8.3f} ms')
+
+def bench_cache():
+    with tempfile.TemporaryDirectory() as cache:
+        for file_count in [ 10000, 50000 ]:
+            data = build_manifest(synthetic_entries(file_count))
+            path = os.path.join(cache, f'{file_count}.rlsc')
+            dl.ManColumns.parse(data).save(path)
+            parse = timeit(lambda: dl.ManColumns.parse(data).file_url(0))
+            load = timeit(lambda: dl.ManColumns.load(path).file_url(0))
+            print(f'cache {file_count:>6} files: parse {parse * 1000:8.2f} ms, mmap load {load * 1000:8.3f} ms')
+
+def write_release(out: str, file_count: int, file_size: int, seed: int = 0) -> bytes:
+    # writes file_count random files under out and returns a manifest that matches them
+    rng = random.Random(seed)
+    entries = []
+    for i in range(0, file_count):
+        path = f'/DATA/folder{i % 7}/file{i}.bin'
+        data = rng.randbytes(file_size)
+        os.makedirs(os.path.dirname(f'{out}{path}'), exist_ok = True)
+        with open(f'{out}{path}', 'wb') as outfile:
+            outfile.write(data)
+        entries.append((path, hashlib.md5(data).digest(), len(data), len(data)))
+    return build_manifest(entries)
+
+def bench_verify():
+    with tempfile.TemporaryDirectory() as out:
+        man = dl.ManColumns.parse(write_release(out, 128, 1024 * 1024))
+        total = sum(man.file_size_uncompressed(i) for i in man.file_range())
+        for threads in [ 1, 2, 4, 8, 16 ]:
+            elapsed = timeit(lambda: all(ok for _, ok in man.verify(out, threads)), 3)
+            print(f'verify {man.file_count()} files x 1 MiB: {threads:>2} threads {elapsed * 1000:8.2f} ms, {total / elapsed / 1024 / 1024:8.1f} MiB/s')
+
+def bench_pool():
+    rng = random.Random(0)
+    manifest, files = make_release((f'/DATA/small{i}.bin', rng.randbytes(1024)) for i in range(0, 2000))
+    man = dl.ManColumns.parse(manifest)
+    with ReleaseServer(files) as server:
+        for pooled in [ False, True ]:
+            pool = dl.HttpPool(8) if pooled else None
+            fetch = lambda file_index: man.file_fetch(file_index, server.url, io.BytesIO(), pool)
+            with ThreadPool(8) as threads:
+                start = time.perf_counter()
+                for _ in threads.imap_unordered(fetch, man.file_range()):
+                    pass
+                elapsed = time.perf_counter() - start
+            print(f'pool {man.file_count()} x 1 KiB over 8 threads: {"keep-alive pool" if pooled else "urlopen":<15} {man.file_count() / elapsed:8.1f} requests/s')
+
+def bench_engine():
+    rng = random.Random(0)
+    manifest, files = make_release((f'/DATA/small{i}.bin', rng.randbytes(4096)) for i in range(0, 2000))
+    man = dl.ManColumns.parse(manifest)
+    with ReleaseServer(files) as server:
+        for engine, concurrency in [ ('threads', 32), ('asyncio', 32), ('asyncio', 256) ]:
+            with tempfile.TemporaryDirectory() as out:
+                dl.make_folders(out, man.folder_plan())
+                start = time.perf_counter()
+                if engine == 'asyncio':
+                    results = list(dl.download_async(man, server.url, out, dl.FileQueue(file_indices = man.file_range()), concurrency, 0, None, 8))
+                else:
+                    pool = dl.HttpPool(concurrency)
+                    with ThreadPool(concurrency) as threads:
+                        results = list(threads.imap_unordered(lambda i: man.file_download(i, server.url, out, 0, None, pool), man.file_range()))
+                elapsed = time.perf_counter() - start
+            assert not any(error for _, error in results)
+            print(f'engine {man.file_count()} x 4 KiB: {engine:<7} {concurrency:>3} in flight {man.file_count() / elapsed:8.1f} files/s')
+
+def bench_schedule():
+    # heavy tailed sizes like a real release, more files than fit in the pipeline queue, plus one giant
+    # that sits last in manifest order
+    rng = random.Random(0)
+    count = dl.PIPELINE_SIZE * 3
+    contents = [ (f'/DATA/file{i}.bin', rng.randbytes(min(int(rng.paretovariate(1.1) * 512), 256 * 1024))) for i in range(0, count) ]
+    contents.append(('/DATA/giant.bin', rng.randbytes(4 * 1024 * 1024)))
+    manifest, files = make_release(contents)
+    man = dl.ManColumns.parse(manifest)
+    total = sum(man.file_size_compressed(i) for i in man.file_range())
+    with ReleaseServer(files, rate = 4 * 1024 * 1024) as server:
+        for schedule, small_threads in [ ('manifest', 0), ('largest', 0), ('largest', 4) ]:
+            with tempfile.TemporaryDirectory() as out:
+                stdout, sys.stdout = sys.stdout, io.StringIO()
+                try:
+                    start = time.perf_counter()
+                    dl.download(server.url, 'bench_project', '0.0.0.1', out, threads = 8, schedule = schedule,
+                                small_threads = small_threads, small_size = 64 * 1024, split_size = 1 << 40)
+                    elapsed = time.perf_counter() - start
+                    log = [ line for line in sys.stdout.getvalue().splitlines() if ' Done ' in line ]
+                finally:
+                    sys.stdout = stdout
+            giant = next(i for i, line in enumerate(log) if line.endswith('giant.bin'))
+            print(f'schedule {man.file_count()} files {total / 1024 / 1024:.1f} MiB at 4 MiB/s per connection: {schedule:<8}'
+                  f' small lane {small_threads} {elapsed:6.2f} s, giant done {giant + 1} of {len(log)}')
+
+def bench_pipeline():
+    # a partly installed release: every other file is on disk and has to be hashed, the rest is missing
+    rng = random.Random(0)
+    contents = [ (f'/DATA/folder{i % 7}/file{i}.bin', rng.randbytes((8 if i % 2 == 0 else 1) * 256 * 1024)) for i in range(0, 64) ]
+    manifest, files = make_release(contents)
+    files['/projects/bench_project/releases/0.0.0.1/releasemanifest'] = manifest
+    with ReleaseServer(files, rate = 8 * 1024 * 1024) as server, tempfile.TemporaryDirectory() as out:
+        stdout, sys.stdout = sys.stdout, io.StringIO()
+        try:
+            for path, data in contents[::2]:
+                os.makedirs(os.path.dirname(f'{out}{path}'), exist_ok = True)
+                with open(f'{out}{path}', 'wb') as outfile:
+                    outfile.write(data)
+            start = time.perf_counter()
+            dl.download(server.url, 'bench_project', '0.0.0.1', out, threads = 8, verify_threads = 1, deep = True)
+            elapsed = time.perf_counter() - start
+            log = sys.stdout.getvalue().splitlines()
+        finally:
+            sys.stdout = stdout
+        first = next(i for i, line in enumerate(log) if ' Done ' in line)
+        verified = next(i for i, line in enumerate(log) if line.startswith('Verified'))
+        print(f'pipeline {len(contents)} files partly installed: {elapsed:6.2f} s, first download done before verification ended: {first < verified}')
+
+def file_extents(path: str) -> int:
+    # number of extents through the linux FIEMAP ioctl, None where that is not available
+    try:
+        import fcntl
+        with open(path, 'rb') as infile:
+            request = bytearray(struct.pack('= Q Q I I I I', 0, 0xFFFFFFFFFFFFFFFF, 0, 0, 0, 0))
+            fcntl.ioctl(infile.fileno(), 0xC020660B, request)
+        return struct.unpack('= Q Q I I I I', request)[3]
+    except (ImportError, OSError):
+        return None
+
+def bench_preallocate():
+    # 8 writers interleaving 64 KiB chunks into their own file, like concurrent downloads do
+    file_size = 32 * 1024 * 1024
+    chunk = random.Random(0).randbytes(dl.CHUNK_SIZE)
+    for preallocate in [ False, True ]:
+        with tempfile.TemporaryDirectory(dir = '.') as out:
+            def write(i):
+                with open(f'{out}/file{i}.bin', 'wb') as outfile:
+                    if preallocate:
+                        dl.file_allocate(outfile, file_size)
+                    for _ in range(0, file_size, len(chunk)):
+                        outfile.write(chunk)
+                    outfile.truncate()
+                    outfile.flush()
+                    os.fsync(outfile.fileno())
+            start = time.perf_counter()
+            with ThreadPool(8) as threads:
+                threads.map(write, range(0, 8))
+            elapsed = time.perf_counter() - start
+            extents = [ file_extents(f'{out}/file{i}.bin') for i in range(0, 8) ]
+            fragments = f'{sum(extents) / len(extents):6.1f} extents/file' if None not in extents else 'extents n/a'
+            print(f'preallocate 8 x 32 MiB interleaved: {"fallocate" if preallocate else "append":<9} {8 * file_size / elapsed / 1024 / 1024:8.1f} MiB/s, {fragments}')
+
+BENCHMARKS = {
+    'parse': bench_parse,
+    'memory': bench_memory,
+    'lookup': bench_lookup,
+    'cache': bench_cache,
+    'verify': bench_verify,
+    'pool': bench_pool,
+    'engine': bench_engine,
+    'schedule': bench_schedule,
+    'pipeline': bench_pipeline,
+    'preallocate': bench_preallocate,
+}
+
+if __name__ == '__main__':
+    for name in sys.argv[1:] or BENCHMARKS.keys():
+        BENCHMARKS[name]()
@@ -22,19 +22,68 @@ OTHER DEALINGS IN THE SOFTWARE.
 For more information, please refer to <http://unlicense.org/>
 ✂--------------------------------[ Cut here ]----------------------------------
 """
+import argparse
+import asyncio
 import base64
 import bz2
 import json
 import struct
-import io
 import os
 import binascii
 import zlib
+import urllib.error
+import urllib.parse
 import urllib.request
+import http.client
 import hashlib
+import mmap
+import queue
+import shutil
+import signal
+import ssl
+import sys
+import threading
+import time
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+from array import array
+from itertools import accumulate, chain, islice
+from collections import deque
+from functools import cached_property
+from contextlib import contextmanager
 from urllib.parse import quote
-from typing import List, NamedTuple
+from typing import Dict, List, NamedTuple, Optional, Tuple
 from multiprocessing.pool import ThreadPool
+from concurrent.futures import ThreadPoolExecutor
+
+CHUNK_SIZE = 64 * 1024
+MAX_REDIRECTS = 10
+REDIRECT_CODES = (301, 302, 303, 307, 308)
+S_COUNT = struct.Struct('< I')
+S_HEADER = struct.Struct('< H H I 4s')
+S_FOLDER = struct.Struct('< I I I I I')
+S_FILE = struct.Struct('< I 4s 16s I I I Q')
+S_NAMES = struct.Struct('< I I')
+S_CACHE_HEADER = struct.Struct('< 4s I I H H I 4s I I')
+S_CACHE_TABLE = struct.Struct('< I I')
+CACHE_FORMAT = 1
+CACHE_BYTEORDER = int.from_bytes(b'\x01\x02\x03\x04', sys.byteorder)
+VERIFY_THREADS = min(32, (os.cpu_count() or 1) + 4)
+IO_THREADS = VERIFY_THREADS
+RESUME_SIZE = 16 * 1024 * 1024
+SPLIT_SIZE = 32 * 1024 * 1024
+SPLIT_SEGMENT = 8 * 1024 * 1024
+SPLIT_WAYS = 4
+SMALL_SIZE = 1024 * 1024
+ADAPTIVE_WINDOW = 1.0
+RATE_BURST = 0.1
+PIPELINE_SIZE = 1024
+FSYNC_BATCH = 64
+FICLONE = 0x40049409
+STATE_FILE = '.old_lol_dl_state.json'
+CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'old_lol_dl')
 
 class ManHeader(NamedTuple):
     major_version: int
@@ -44,7 +93,6 @@ class ManHeader(NamedTuple):
     
     @staticmethod
     def read(buffer):
-        S_HEADER = struct.Struct('< H H I 4s')
         return ManHeader(*S_HEADER.unpack_from(buffer.read(S_HEADER.size)))
 
 class ManFolder(NamedTuple):
@@ -62,7 +110,6 @@ class ManFolder(NamedTuple):
     
     @staticmethod
     def read(buffer):
-        S_FOLDER = struct.Struct('< I I I I I')
         return ManFolder(*S_FOLDER.unpack_from(buffer.read(S_FOLDER.size)))
 
 class ManFile(NamedTuple):
@@ -76,99 +123,412 @@ class ManFile(NamedTuple):
 
     @staticmethod
     def read(buffer):
-        S_FILE = struct.Struct('< I 4s 16s I I I Q')
         return ManFile(*S_FILE.unpack_from(buffer.read(S_FILE.size)))
 
-class Man(NamedTuple):
+class ManBase:
+    # accessors shared by every Man backend, built on top of the file_*/folder_* primitives
     header: ManHeader
-    folders: List[ManFolder]
-    folder_parents: List[int]
-    files: List[ManFile]
-    file_parents: List[int]
     names: List[str]
-    
+
     def project_name(self) -> str:
         return self.names[self.header.project_name]
 
     def release_version(self) -> str:
         return ".".join(str(x) for x in reversed(self.header.release_version))
     
-    def file_count(self) -> int:
-        return len(self.files)
-    
-    def file_range(self) -> int:
-        return range(0, len(self.files))
-    
-    def file_name(self, file_index: int) -> str:
-        return f'{self.names[self.files[file_index].name]}'
+    def file_range(self) -> range:
+        return range(0, self.file_count())
     
+    @cached_property
+    def folder_paths(self) -> List[str]:
+        # full path of every folder, built once top down from the roots
+        paths = [ '' ] * self.folder_count()
+        pending = [ (folder_index, '') for folder_index in range(0, self.folder_count()) if self.folder_parent(folder_index) == None ]
+        while pending:
+            folder_index, parent_path = pending.pop()
+            path = paths[folder_index] = f'{parent_path}{self.folder_name(folder_index)}/'
+            pending.extend((sub, path) for sub in self.folder_folders(folder_index))
+        return paths
+
+    @cached_property
+    def folder_urls(self) -> List[str]:
+        # quote works character by character so quoted pieces can be concatenated
+        return [ quote(path) for path in self.folder_paths ]
+
+    @cached_property
+    def url_prefix(self) -> str:
+        return quote(f'projects/{self.project_name()}/releases/')
+
     def file_folder(self, file_index: int) -> str:
-        name = ''
-        folder_index = self.file_parents[file_index]
-        while folder_index != None:
-            name = f'{self.names[self.folders[folder_index].name]}/{name}'
-            folder_index = self.folder_parents[folder_index]
-        return name
+        folder_index = self.file_parent(file_index)
+        return '' if folder_index == None else self.folder_paths[folder_index]
     
     def file_path(self, file_index: int) -> str:
         return f'{self.file_folder(file_index)}{self.file_name(file_index)}'
     
     def file_url(self, file_index: int) -> str:
-        project = self.project_name()
+        folder_index = self.file_parent(file_index)
+        folder = '' if folder_index == None else self.folder_urls[folder_index]
         version = self.file_version(file_index)
-        path = self.file_path(file_index)
-        return quote(f'projects/{project}/releases/{version}/files{path}.compressed')
-    
-    def file_version(self, file_index: int) -> str:
-        return ".".join(str(x) for x in reversed(self.files[file_index].version))
+        return f'{self.url_prefix}{version}/files{folder}{quote(self.file_name(file_index))}.compressed'
     
     def file_md5_hex(self, file_index: int) -> str:
-        return binascii.hexlify(self.files[file_index].md5).decode('utf-8')
+        return binascii.hexlify(self.file_md5(file_index)).decode('utf-8')
 
-    def file_deploy_mode(self, file_index: int) -> int:
-        return self.files[file_index].deploy_mode
-    
-    def file_size_uncompressed(self, file_index: int) -> int:
-        return self.files[file_index].size_uncompressed
-    
-    def file_size_compressed(self, file_index: int) -> int:
-        return self.files[file_index].size_compressed
+    @staticmethod
+    def normalize_path(path: str) -> str:
+        return '/' + path.replace('\\', '/').lstrip('/')
+
+    @cached_property
+    def file_path_index(self) -> Dict[str, int]:
+        return { self.file_path(file_index): file_index for file_index in self.file_range() }
+
+    @cached_property
+    def file_path_index_casefold(self) -> Dict[str, int]:
+        index = {}
+        for path, file_index in self.file_path_index.items():
+            index.setdefault(path.casefold(), file_index)
+        return index
+
+    @cached_property
+    def file_md5_index(self) -> Dict[bytes, List[int]]:
+        index = {}
+        for file_index in self.file_range():
+            index.setdefault(self.file_md5(file_index), []).append(file_index)
+        return index
+
+    @cached_property
+    def folder_path_index(self) -> Dict[str, int]:
+        return { path: folder_index for folder_index, path in enumerate(self.folder_paths) }
+
+    @cached_property
+    def folder_path_index_casefold(self) -> Dict[str, int]:
+        index = {}
+        for path, folder_index in self.folder_path_index.items():
+            index.setdefault(path.casefold(), folder_index)
+        return index
+
+    @cached_property
+    def folder_descendants(self) -> Tuple[array, array, array]:
+        # files in depth first order, every folder owns the contiguous span [start, end) of it
+        order = array('I')
+        starts = array('I', [ 0 ]) * self.folder_count()
+        ends = array('I', [ 0 ]) * self.folder_count()
+        pending = [ folder_index for folder_index in range(0, self.folder_count()) if self.folder_parent(folder_index) == None ]
+        while pending:
+            folder_index = pending.pop()
+            if folder_index < 0:
+                ends[~folder_index] = len(order)
+                continue
+            starts[folder_index] = len(order)
+            order.extend(self.folder_files(folder_index))
+            pending.append(~folder_index)
+            pending.extend(reversed(self.folder_folders(folder_index)))
+        return order, starts, ends
+
+    def file_lookup(self, path: str, casefold: bool = False) -> Optional[int]:
+        path = self.normalize_path(path)
+        if casefold:
+            return self.file_path_index_casefold.get(path.casefold())
+        return self.file_path_index.get(path)
 
-    def file_verify(self, file_index: int, out: str) -> int:
-        path = f'{out}{self.file_path(file_index)}'
-        if not os.path.exists(path):
+    def file_lookup_md5(self, md5) -> List[int]:
+        if isinstance(md5, str):
+            md5 = bytes.fromhex(md5)
+        return self.file_md5_index.get(md5, [])
+
+    def folder_lookup(self, path: str, casefold: bool = False) -> Optional[int]:
+        path = self.normalize_path(path).rstrip('/') + '/'
+        if casefold:
+            return self.folder_path_index_casefold.get(path.casefold())
+        return self.folder_path_index.get(path)
+
+    def folder_descendant_files(self, folder_index: int) -> array:
+        order, starts, ends = self.folder_descendants
+        return order[starts[folder_index]:ends[folder_index]]
+
+    def file_verify(self, file_index: int, out: str, state: 'VerifyState' = None, deep: bool = False,
+                    scan: 'OutputScan' = None) -> int:
+        name = self.file_path(file_index)
+        path = f'{out}{name}'
+        try:
+            stat = os.stat(path) if scan is None else scan.stat(name)
+        except OSError:
             return False
-        size = os.path.getsize(path)
-        if not size == self.file_size_uncompressed(file_index):
+        if stat is None or not stat.st_size == self.file_size_uncompressed(file_index):
             return False
+        md5_hex = self.file_md5_hex(file_index)
+        if state is not None and not deep and state.check(name, stat, md5_hex):
+            return True
         hash_md5 = hashlib.md5()
         with open(path, "rb") as f:
-            for chunk in iter(lambda: f.read(64 * 1024), b""):
+            for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
                 hash_md5.update(chunk)
-        if not hash_md5.hexdigest() == self.file_md5_hex(file_index):
+        if not hash_md5.hexdigest() == md5_hex:
+            if state is not None:
+                state.forget(name)
             return False
+        if state is not None:
+            state.record(name, stat, md5_hex)
         return True
 
-    def file_download(self, file_index: int, cdn: str, out: str, retries: int = 3):
-        path = f'{out}{self.file_path(file_index)}'
+    def scan_split(self, scan: 'OutputScan', file_indices = None) -> Tuple[List[int], List[int]]:
+        # (missing or wrong size, matching size) files by the scan alone, without reading anything
+        missing, matching = [], []
+        for file_index in self.file_range() if file_indices is None else file_indices:
+            stat = scan.stat(self.file_path(file_index))
+            if stat is None or not stat.st_size == self.file_size_uncompressed(file_index):
+                missing.append(file_index)
+            else:
+                matching.append(file_index)
+        return missing, matching
+
+    def verify(self, out: str, threads: int = VERIFY_THREADS, file_indices = None, state: 'VerifyState' = None, deep: bool = False,
+               scan: 'OutputScan' = None):
+        # md5 and file reads release the gil, so a thread pool keeps cores and the disk queue busy,
+        # (file_index, ok) pairs are yielded as they finish
+        file_indices = self.file_range() if file_indices is None else file_indices
+        if scan is not None:
+            # missing and wrong size files are settled from the scan, only the rest go to the pool
+            missing, file_indices = self.scan_split(scan, file_indices)
+            yield from ((file_index, False) for file_index in missing)
+        check = lambda file_index: (file_index, self.file_verify(file_index, out, state, deep, scan))
+        with ThreadPool(threads) as pool:
+            yield from pool.imap_unordered(check, file_indices, chunksize = 16)
+
+    def folder_plan(self, scan: 'OutputScan' = None) -> List[str]:
+        # every folder of the release that is not on disk yet, sorted so parents come before their children
+        existing = scan.folders if scan is not None else set()
+        folders = (path.rstrip('/') for path in self.folder_paths)
+        return sorted(folder for folder in folders if folder and folder not in existing)
+
+    def file_memory(self, file_index: int, split_size: int = SPLIT_SIZE) -> int:
+        # peak bytes a download of the file holds: a compressed chunk and an inflated window when streamed,
+        # plus SPLIT_WAYS segments in flight and the one being written when fetched as split ranges, never
+        # more than the whole file
+        size = self.file_size_compressed(file_index)
+        window = 2 * CHUNK_SIZE
+        if split_size and size >= split_size:
+            window += (SPLIT_WAYS + 1) * SPLIT_SEGMENT
+        return min(window, size + self.file_size_uncompressed(file_index))
+
+    def file_fetch(self, file_index: int, cdn: str, outfile, pool: 'HttpPool' = None, part: str = None,
+                   split_size: int = SPLIT_SIZE) -> str:
+        writer = InflateWriter(outfile)
+        url = f'{cdn}/{self.file_url(file_index)}'
+        size = self.file_size_compressed(file_index)
+        if part is None:
+            for chunk in http_read(url, pool, 0, size, split_size):
+                writer.write(chunk)
+            return writer.finish()
+        # the compressed bytes are also kept in part, after a failure the next attempt replays them
+        # through a fresh decompressor and only asks the server for the rest
+        with open(part, 'a+b') as partfile:
+            def restart() -> InflateWriter:
+                partfile.truncate(0)
+                outfile.seek(0)
+                outfile.truncate(0)
+                return InflateWriter(outfile)
+            partfile.seek(0)
+            try:
+                for chunk in iter(lambda: partfile.read(CHUNK_SIZE), b""):
+                    writer.write(chunk)
+                offset = partfile.tell()
+            except zlib.error:
+                # bytes that do not decode are never going to, drop them instead of replaying them forever
+                writer = restart()
+                offset = 0
+            if offset > size:
+                writer = restart()
+                offset = 0
+            try:
+                if offset < size:
+                    for chunk in http_read(url, pool, offset, size, split_size):
+                        if chunk is None:
+                            # no range support, start over
+                            writer = restart()
+                            continue
+                        partfile.write(chunk)
+                        writer.write(chunk)
+                if partfile.tell() < size:
+                    # the connection ended early without an error, keep what arrived for the next attempt
+                    raise http.client.IncompleteRead(b'', size - partfile.tell())
+                return writer.finish()
+            except urllib.error.HTTPError as err:
+                if err.code == 416:
+                    partfile.truncate(0)
+                raise
+            except (zlib.error, ValueError):
+                # the complete part does not decode, the next attempt starts from zero
+                partfile.truncate(0)
+                raise
+
+    def file_write(self, file_index: int, cdn: str, path: str, temp: str, retries: int = 3, pool: 'HttpPool' = None,
+                   resume_size: int = RESUME_SIZE, split_size: int = SPLIT_SIZE, durability: 'Durability' = None,
+                   preallocate: bool = False) -> os.stat_result:
+        # written to temp and only renamed over path once the md5 matches, so a crash or a failed attempt
+        # never leaves a truncated file behind under the real name, raises the last error once out of retries
+        md5_hex = self.file_md5_hex(file_index)
+        # named after the md5 so a part left over from another release is never resumed
+        part = f'{path}.{md5_hex}.part' if self.file_size_compressed(file_index) >= resume_size else None
+        while True:
+            try:
+                with open(temp, 'wb') as outfile:
+                    if preallocate:
+                        file_allocate(outfile, self.file_size_uncompressed(file_index))
+                    # hashed on the way to disk, so a fresh download never has to be read back to be trusted
+                    if not self.file_fetch(file_index, cdn, outfile, pool, part, split_size) == md5_hex:
+                        if part is not None:
+                            os.remove(part)
+                        raise ValueError(f'md5 mismatch, expected {md5_hex}')
+                    if preallocate:
+                        outfile.truncate()
+                    outfile.flush()
+                    if durability is not None:
+                        durability.written(outfile)
+                    stat = os.fstat(outfile.fileno())
+                os.replace(temp, path)
+                break
+            except Exception:
+                if not retries:
+                    if os.path.exists(temp):
+                        os.remove(temp)
+                    raise
+                retries -= 1
+        if durability is not None:
+            durability.renamed(path)
+        if part is not None and os.path.exists(part):
+            os.remove(part)
+        return stat
+
+    def file_download(self, file_index: int, cdn: str, out: str, retries: int = 3, state: 'VerifyState' = None,
+                      pool: 'HttpPool' = None, resume_size: int = RESUME_SIZE, split_size: int = SPLIT_SIZE,
+                      durability: 'Durability' = None, preallocate: bool = False, store: 'ContentStore' = None):
+        name = self.file_path(file_index)
+        path = f'{out}{name}'
         try:
-            os.makedirs(f'{out}/{self.file_folder(file_index)}', exist_ok = True)
-            data = bytes()
-            while True:
-                try:
-                    data = urllib.request.urlopen(f'{cdn}/{self.file_url(file_index)}').read()
-                    data = zlib.decompress(data)
-                    break
-                except Exception as err:
-                    if not retries:
-                        return path, err
-                    retries -= 1
-            with open(path, 'wb') as outfile:
-                outfile.write(data)
+            md5_hex = self.file_md5_hex(file_index)
+            if store is None:
+                stat = self.file_write(file_index, cdn, path, f'{path}.tmp', retries, pool, resume_size, split_size,
+                                       durability, preallocate)
+            else:
+                # one download per md5 at a time, a second file with the same content finds it in the store
+                with store.locked(md5_hex):
+                    if not store.has(md5_hex, self.file_size_uncompressed(file_index), path):
+                        self.file_write(file_index, cdn, store.path(md5_hex), store.temp(md5_hex), retries, pool,
+                                        resume_size, split_size, durability, preallocate)
+                stat = store.materialize(md5_hex, path, durability)
+            if state is not None:
+                state.record(name, stat, md5_hex)
             return path, None
         except Exception as err:
             return path, err
 
+    async def file_download_async(self, file_index: int, cdn: str, out: str, retries: int, state: 'VerifyState',
+                                  pool: 'AsyncHttpPool', executor: ThreadPoolExecutor, durability: 'Durability' = None,
+                                  preallocate: bool = False, store: 'ContentStore' = None):
+        # same steps as file_download, with every disk write and decompression handed to the executor
+        loop = asyncio.get_running_loop()
+        name = self.file_path(file_index)
+        path = f'{out}{name}'
+        md5_hex = self.file_md5_hex(file_index)
+        target = path if store is None else store.path(md5_hex)
+        temp = f'{path}.tmp' if store is None else store.temp(md5_hex)
+        def begin():
+            outfile = open(temp, 'wb')
+            if preallocate:
+                file_allocate(outfile, self.file_size_uncompressed(file_index))
+            return InflateWriter(outfile)
+        def commit(writer: InflateWriter):
+            with writer.outfile:
+                if not writer.finish() == md5_hex:
+                    raise ValueError(f'md5 mismatch, expected {md5_hex}')
+                if preallocate:
+                    writer.outfile.truncate()
+                writer.outfile.flush()
+                if durability is not None:
+                    durability.written(writer.outfile)
+                stat = os.fstat(writer.outfile.fileno())
+            os.replace(temp, target)
+            if durability is not None:
+                durability.renamed(target)
+            return stat
+        def discard(writer: InflateWriter):
+            writer.outfile.close()
+            if os.path.exists(temp):
+                os.remove(temp)
+        try:
+            url = f'{cdn}/{self.file_url(file_index)}'
+            if store is None or not await loop.run_in_executor(executor, store.has, md5_hex, self.file_size_uncompressed(file_index), path):
+                while True:
+                    writer = await loop.run_in_executor(executor, begin)
+                    try:
+                        await pool.fetch(url, lambda chunk: loop.run_in_executor(executor, writer.write, chunk))
+                        stat = await loop.run_in_executor(executor, commit, writer)
+                        break
+                    except Exception as err:
+                        if not retries:
+                            await loop.run_in_executor(executor, discard, writer)
+                            return path, err
+                        await loop.run_in_executor(executor, writer.outfile.close)
+                        retries -= 1
+            if store is not None:
+                stat = await loop.run_in_executor(executor, store.materialize, md5_hex, path, durability)
+            if state is not None:
+                state.record(name, stat, md5_hex)
+            return path, None
+        except Exception as err:
+            return path, err
+
+class Man(ManBase):
+    def __init__(self, header: ManHeader, folders: List[ManFolder], folder_parents: List[int],
+                 files: List[ManFile], file_parents: List[int], names: List[str]):
+        self.header = header
+        self.folders = folders
+        self.folder_parents = folder_parents
+        self.files = files
+        self.file_parents = file_parents
+        self.names = names
+
+    def folder_count(self) -> int:
+        return len(self.folders)
+
+    def folder_name(self, folder_index: int) -> str:
+        return self.names[self.folders[folder_index].name]
+
+    def folder_parent(self, folder_index: int) -> int:
+        return self.folder_parents[folder_index]
+
+    def folder_folders(self, folder_index: int) -> range:
+        return self.folders[folder_index].folders()
+
+    def folder_files(self, folder_index: int) -> range:
+        return self.folders[folder_index].files()
+    
+    def file_count(self) -> int:
+        return len(self.files)
+    
+    def file_name(self, file_index: int) -> str:
+        return f'{self.names[self.files[file_index].name]}'
+
+    def file_parent(self, file_index: int) -> int:
+        return self.file_parents[file_index]
+    
+    def file_version(self, file_index: int) -> str:
+        return ".".join(str(x) for x in reversed(self.files[file_index].version))
+
+    def file_md5(self, file_index: int) -> bytes:
+        return self.files[file_index].md5
+
+    def file_deploy_mode(self, file_index: int) -> int:
+        return self.files[file_index].deploy_mode
+    
+    def file_size_uncompressed(self, file_index: int) -> int:
+        return self.files[file_index].size_uncompressed
+    
+    def file_size_compressed(self, file_index: int) -> int:
+        return self.files[file_index].size_compressed
+
     @staticmethod
     def read(buffer):
         magic = buffer.read(4)
@@ -182,36 +542,1316 @@ class Man(NamedTuple):
         name_data_length = int.from_bytes(buffer.read(4), byteorder='little')
         names = buffer.read(name_data_length).decode('utf-8').split('\0')
         # assert(len(names) == name_count)
-        folder_parents = [ None ] * folder_count
-        file_parents = [ None ] * file_count
-        for parent, folder in enumerate(folders):
-            for sub in folder.folders():
-                folder_parents[sub] = parent
-            for sub in folder.files():
-                file_parents[sub] = parent
+        return Man.build(header, folders, files, names)
+
+    @staticmethod
+    def parse(data):
+        # bulk variant of read: decode each table with one iter_unpack over a view of the whole manifest
+        view = memoryview(data)
+        assert(view[0:4] == b"RLSM")
+        offset = 4
+        header = ManHeader._make(S_HEADER.unpack_from(view, offset))
+        offset += S_HEADER.size
+        folder_count, = S_COUNT.unpack_from(view, offset)
+        offset += S_COUNT.size
+        end = offset + folder_count * S_FOLDER.size
+        folders = list(map(ManFolder._make, S_FOLDER.iter_unpack(view[offset:end])))
+        file_count, = S_COUNT.unpack_from(view, end)
+        offset = end + S_COUNT.size
+        end = offset + file_count * S_FILE.size
+        files = list(map(ManFile._make, S_FILE.iter_unpack(view[offset:end])))
+        name_count, name_data_length = S_NAMES.unpack_from(view, end)
+        offset = end + S_NAMES.size
+        names = str(view[offset:offset + name_data_length], 'utf-8').split('\0')
+        return Man.build(header, folders, files, names)
+
+    @staticmethod
+    def build(header, folders, files, names):
+        folder_parents = [ None ] * len(folders)
+        file_parents = [ None ] * len(files)
+        for parent, (_, folders_start, folders_count, files_start, files_count) in enumerate(folders):
+            folder_parents[folders_start:folders_start + folders_count] = [ parent ] * folders_count
+            file_parents[files_start:files_start + files_count] = [ parent ] * files_count
         return Man(header, folders, folder_parents, files, file_parents, names)
 
-def download(cdn: str, project: str, version: str, output: str, threads: int = 32, retries = 3):
+class ManNames:
+    # every name in one utf-8 block plus a column of running name lengths instead of a list of
+    # small strings, name i starts after i separators so its offset is lengths[i] + i
+    def __init__(self, data, lengths: array = None):
+        if lengths is None:
+            lengths = array('I', [ 0 ])
+            lengths.extend(accumulate(map(len, bytes(data).split(b'\0'))))
+        self.data = data
+        self.lengths = lengths
+
+    def __len__(self) -> int:
+        return len(self.lengths) - 1
+
+    def __getitem__(self, index: int) -> str:
+        return str(self.data[self.lengths[index] + index:self.lengths[index + 1] + index], 'utf-8')
+
+    def __iter__(self):
+        return map(self.__getitem__, range(0, len(self)))
+
+    @staticmethod
+    def join(strings) -> 'ManNames':
+        return ManNames('\0'.join(strings).encode('utf-8'))
+
+class ManFolderColumns(NamedTuple):
+    name: array
+    folders_start: array
+    folders_count: array
+    files_start: array
+    files_count: array
+    parent: array
+
+class ManFileColumns(NamedTuple):
+    name: array
+    version: array
+    md5: bytes
+    deploy_mode: array
+    size_uncompressed: array
+    size_compressed: array
+    date: array
+    parent: array
+
+class ManStream:
+    # incremental RLSM decoder: feed it chunks as they arrive and every complete folder and file record
+    # is decoded right away, so parsing overlaps the transfer and the body is never held twice.
+    # names come last in the format, so paths can only be resolved once the stream is done
+    def __init__(self, on_folder = None, on_file = None):
+        self.pending = bytearray()
+        self.header = None
+        self.folder_count = None
+        self.folder_words = array('I')
+        self.file_count = None
+        self.file_words = array('I')
+        self.name_data_length = None
+        self.name_data = None
+        self.on_folder = on_folder
+        self.on_file = on_file
+
+    def done(self) -> bool:
+        return self.name_data is not None
+
+    def feed(self, chunk: bytes):
+        self.pending += chunk
+        while not self.done() and self.step():
+            pass
+
+    def take(self, size: int) -> bytes:
+        data = bytes(self.pending[:size])
+        del self.pending[:size]
+        return data
+
+    def take_records(self, words: array, count: int, record: struct.Struct, on_record, make):
+        first = len(words) * 4 // record.size
+        available = min(count - first, len(self.pending) // record.size)
+        data = self.take(available * record.size)
+        words.frombytes(data)
+        if on_record:
+            for index, fields in enumerate(record.iter_unpack(data), first):
+                on_record(index, make(fields))
+        return available > 0
+
+    def step(self) -> bool:
+        # decodes as much of the current section as pending allows, False when more data is needed
+        if self.header is None:
+            if len(self.pending) < 4 + S_HEADER.size:
+                return False
+            magic = self.take(4)
+            assert(magic == b"RLSM")
+            self.header = ManHeader._make(S_HEADER.unpack(self.take(S_HEADER.size)))
+        elif self.folder_count is None:
+            if len(self.pending) < S_COUNT.size:
+                return False
+            self.folder_count, = S_COUNT.unpack(self.take(S_COUNT.size))
+        elif len(self.folder_words) < self.folder_count * 5:
+            return self.take_records(self.folder_words, self.folder_count, S_FOLDER, self.on_folder, ManFolder._make)
+        elif self.file_count is None:
+            if len(self.pending) < S_COUNT.size:
+                return False
+            self.file_count, = S_COUNT.unpack(self.take(S_COUNT.size))
+        elif len(self.file_words) < self.file_count * 11:
+            return self.take_records(self.file_words, self.file_count, S_FILE, self.on_file, ManFile._make)
+        elif self.name_data_length is None:
+            if len(self.pending) < S_NAMES.size:
+                return False
+            name_count, self.name_data_length = S_NAMES.unpack(self.take(S_NAMES.size))
+        else:
+            if len(self.pending) < self.name_data_length:
+                return False
+            self.name_data = self.take(self.name_data_length)
+        return True
+
+    def result(self) -> 'ManColumns':
+        if not self.done():
+            raise ValueError('manifest ended early')
+        return ManColumns.build(self.header, self.folder_words, self.file_words, self.name_data)
+
+class ManColumns(ManBase):
+    # compact backend: one typed column per field, 16 byte md5s packed back to back and -1 for "no parent"
+    def __init__(self, header: ManHeader, folders: ManFolderColumns, files: ManFileColumns, names: ManNames,
+                 folder_paths: ManNames = None, folder_urls: ManNames = None):
+        self.header = header
+        self.folders = folders
+        self.files = files
+        self.names = names
+        if folder_paths is not None:
+            self.folder_paths = folder_paths
+        if folder_urls is not None:
+            self.folder_urls = folder_urls
+
+    def folder_count(self) -> int:
+        return len(self.folders.name)
+
+    def folder_name(self, folder_index: int) -> str:
+        return self.names[self.folders.name[folder_index]]
+
+    def folder_parent(self, folder_index: int) -> int:
+        parent = self.folders.parent[folder_index]
+        return None if parent < 0 else parent
+
+    def folder_folders(self, folder_index: int) -> range:
+        start = self.folders.folders_start[folder_index]
+        return range(start, start + self.folders.folders_count[folder_index])
+
+    def folder_files(self, folder_index: int) -> range:
+        start = self.folders.files_start[folder_index]
+        return range(start, start + self.folders.files_count[folder_index])
+
+    def file_count(self) -> int:
+        return len(self.files.name)
+
+    def file_name(self, file_index: int) -> str:
+        return self.names[self.files.name[file_index]]
+
+    def file_parent(self, file_index: int) -> int:
+        parent = self.files.parent[file_index]
+        return None if parent < 0 else parent
+
+    def file_version(self, file_index: int) -> str:
+        version = self.files.version[file_index]
+        return f'{version >> 24}.{version >> 16 & 0xFF}.{version >> 8 & 0xFF}.{version & 0xFF}'
+
+    def file_md5(self, file_index: int) -> bytes:
+        return bytes(self.files.md5[file_index * 16:file_index * 16 + 16])
+
+    def file_deploy_mode(self, file_index: int) -> int:
+        return self.files.deploy_mode[file_index]
+
+    def file_size_uncompressed(self, file_index: int) -> int:
+        return self.files.size_uncompressed[file_index]
+
+    def file_size_compressed(self, file_index: int) -> int:
+        return self.files.size_compressed[file_index]
+
+    @staticmethod
+    def parse(data):
+        view = memoryview(data)
+        assert(view[0:4] == b"RLSM")
+        header = ManHeader._make(S_HEADER.unpack_from(view, 4))
+        offset = 4 + S_HEADER.size
+        folder_count, = S_COUNT.unpack_from(view, offset)
+        offset += S_COUNT.size
+        end = offset + folder_count * S_FOLDER.size
+        folder_words = array('I')
+        folder_words.frombytes(view[offset:end])
+        file_count, = S_COUNT.unpack_from(view, end)
+        offset = end + S_COUNT.size
+        end = offset + file_count * S_FILE.size
+        file_words = array('I')
+        file_words.frombytes(view[offset:end])
+        name_count, name_data_length = S_NAMES.unpack_from(view, end)
+        offset = end + S_NAMES.size
+        return ManColumns.build(header, folder_words, file_words, bytes(view[offset:offset + name_data_length]))
+
+    @staticmethod
+    def read(buffer, chunk_size: int = 64 * 1024, tee = None, on_folder = None, on_file = None) -> 'ManColumns':
+        # streaming variant of parse for a file or http response, see ManStream
+        stream = ManStream(on_folder, on_file)
+        for chunk in iter(lambda: buffer.read(chunk_size), b""):
+            if tee:
+                tee.write(chunk)
+            stream.feed(chunk)
+        return stream.result()
+
+    @staticmethod
+    def build(header: ManHeader, folder_words: array, file_words: array, name_data: bytes) -> 'ManColumns':
+        # every record is made of little endian 32bit words, so the raw tables are split into columns
+        # with strided slices
+        folder_count = len(folder_words) // 5
+        file_count = len(file_words) // 11
+        folder_columns = [ folder_words[i::5] for i in range(0, 5) ]
+        md5 = array('I', bytes(file_count * 16))
+        for i in range(0, 4):
+            md5[i::4] = file_words[2 + i::11]
+        date = array('I', bytes(file_count * 8))
+        date[0::2] = file_words[9::11]
+        date[1::2] = file_words[10::11]
+        date = array('Q', date.tobytes())
+        numeric = [ file_words[0::11], file_words[1::11], file_words[6::11], file_words[7::11], file_words[8::11], date ]
+        if sys.byteorder != 'little':
+            for column in folder_columns + numeric:
+                column.byteswap()
+        folder_parents = array('i', [ -1 ]) * folder_count
+        file_parents = array('i', [ -1 ]) * file_count
+        for parent, (folders_start, folders_count, files_start, files_count) in enumerate(zip(*folder_columns[1:])):
+            folder_parents[folders_start:folders_start + folders_count] = array('i', [ parent ]) * folders_count
+            file_parents[files_start:files_start + files_count] = array('i', [ parent ]) * files_count
+        name, version, deploy_mode, size_uncompressed, size_compressed, date = numeric
+        folders = ManFolderColumns(*folder_columns, folder_parents)
+        files = ManFileColumns(name, version, md5.tobytes(), deploy_mode, size_uncompressed, size_compressed, date, file_parents)
+        return ManColumns(header, folders, files, ManNames(name_data))
+
+    def save(self, path: str):
+        # fixed layout cache: header, then every column and string table back to back, 8 byte aligned,
+        # in native byte order so load can cast them in place
+        tables = [ self.names, ManNames.join(self.folder_paths), ManNames.join(self.folder_urls) ]
+        with open(f'{path}.tmp', 'wb') as outfile:
+            outfile.write(S_CACHE_HEADER.pack(b'RLSC', CACHE_FORMAT, CACHE_BYTEORDER, *self.header,
+                                              self.folder_count(), self.file_count()))
+            for column in [ *self.folders, *self.files ]:
+                outfile.write(column)
+                outfile.write(bytes(-len(memoryview(column).cast('B')) % 8))
+            for table in tables:
+                data = memoryview(table.data).cast('B')
+                outfile.write(S_CACHE_TABLE.pack(len(table), len(data)))
+                outfile.write(table.lengths)
+                outfile.write(bytes(-len(table.lengths) * 4 % 8))
+                outfile.write(data)
+                outfile.write(bytes(-len(data) % 8))
+        os.replace(f'{path}.tmp', path)
+
+    @staticmethod
+    def load(path: str) -> 'ManColumns':
+        # maps a file written by save, every column is a memoryview straight into the mapping
+        with open(path, 'rb') as infile:
+            view = memoryview(mmap.mmap(infile.fileno(), 0, access = mmap.ACCESS_READ))
+        magic, version, byteorder, *header, folder_count, file_count = S_CACHE_HEADER.unpack_from(view, 0)
+        if magic != b'RLSC' or version != CACHE_FORMAT or byteorder != CACHE_BYTEORDER:
+            raise ValueError(f'{path} is not a compatible manifest cache')
+        offset = S_CACHE_HEADER.size
+        def take(size: int):
+            nonlocal offset
+            if offset + size > len(view):
+                raise ValueError(f'{path} is truncated')
+            result = view[offset:offset + size]
+            offset += size + (-size % 8)
+            return result
+        def column(typecode: str, count: int):
+            return take(count * array(typecode).itemsize).cast(typecode)
+        def table():
+            count, length = S_CACHE_TABLE.unpack(take(S_CACHE_TABLE.size))
+            lengths = column('I', count + 1)
+            return ManNames(take(length), lengths)
+        folders = ManFolderColumns(*[ column(typecode, folder_count) for typecode in 'IIIIIi' ])
+        files = ManFileColumns(column('I', file_count), column('I', file_count), take(file_count * 16),
+                               column('I', file_count), column('I', file_count), column('I', file_count),
+                               column('Q', file_count), column('i', file_count))
+        names, folder_paths, folder_urls = table(), table(), table()
+        return ManColumns(ManHeader(*header), folders, files, names, folder_paths, folder_urls)
+
+class ManDiff(NamedTuple):
+    # how every file of a new release relates to an old one, indices into the old and new manifests,
+    # moved pairs name the old file whose content is reused for the new path
+    unchanged: List[int]
+    moved: List[Tuple[int, int]]
+    changed: List[Tuple[int, int]]
+    added: List[int]
+    removed: List[int]
+
+    @staticmethod
+    def build(old: ManBase, new: ManBase) -> 'ManDiff':
+        old_paths = old.file_path_index
+        new_paths = new.file_path_index
+        removed = [ file_index for file_index in old.file_range() if old.file_path(file_index) not in new_paths ]
+        # content is preferably taken from a removed file, which can then be renamed instead of copied
+        sources = { old.file_md5(file_index): file_index for file_index in old.file_range() }
+        sources.update((old.file_md5(file_index), file_index) for file_index in removed)
+        unchanged, moved, changed, added = [], [], [], []
+        for file_index in new.file_range():
+            old_index = old_paths.get(new.file_path(file_index))
+            md5 = new.file_md5(file_index)
+            if old_index is not None:
+                if old.file_md5(old_index) == md5:
+                    unchanged.append(file_index)
+                else:
+                    changed.append((old_index, file_index))
+            elif md5 in sources:
+                moved.append((sources[md5], file_index))
+            else:
+                added.append(file_index)
+        return ManDiff(unchanged, moved, changed, added, removed)
+
+class InflateWriter:
+    # streams compressed chunks through a bounded decompressor straight into outfile, hashing what is
+    # written, so memory per file stays at a few chunks however large the file is
+    def __init__(self, outfile):
+        self.outfile = outfile
+        self.decompressor = zlib.decompressobj()
+        self.hash_md5 = hashlib.md5()
+
+    def write(self, chunk: bytes):
+        # fed CHUNK_SIZE at a time, the unconsumed tail of a whole split segment would be another copy of it
+        with memoryview(chunk) as view:
+            for start in range(0, len(view), CHUNK_SIZE):
+                data = self.decompressor.decompress(view[start:start + CHUNK_SIZE], CHUNK_SIZE)
+                while data:
+                    self.hash_md5.update(data)
+                    self.outfile.write(data)
+                    data = self.decompressor.decompress(self.decompressor.unconsumed_tail, CHUNK_SIZE)
+
+    def finish(self) -> str:
+        data = self.decompressor.flush()
+        self.hash_md5.update(data)
+        self.outfile.write(data)
+        if not self.decompressor.eof:
+            raise ValueError('compressed stream ended early')
+        return self.hash_md5.hexdigest()
+
+class TokenBucket:
+    # process wide bandwidth cap shared by every reader, each one charges the bytes it just received and
+    # sleeps off any debt, the bucket only holds RATE_BURST seconds worth of tokens so bursts stay short
+    def __init__(self, rate: int = None):
+        self.lock = threading.Lock()
+        self.wake = threading.Event()
+        self.watching = set()
+        self.set_rate(rate)
+
+    def set_rate(self, rate: int = None):
+        with self.lock:
+            self.rate = rate or None
+            self.burst = max(CHUNK_SIZE, int(rate * RATE_BURST)) if rate else 0
+            self.tokens = self.burst
+            self.stamp = time.monotonic()
+
+    def delay(self, size: int) -> float:
+        # takes size bytes out of the bucket, returns how long the caller has to wait for them
+        if self.rate is None:
+            return 0
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate) - size
+            self.stamp = now
+            return -self.tokens / self.rate if self.tokens < 0 else 0
+
+    def take(self, size: int):
+        delay = self.delay(size)
+        if delay > 0:
+            time.sleep(delay)
+
+    def limit(self, chunks):
+        for chunk in chunks:
+            if chunk:
+                self.take(len(chunk))
+            yield chunk
+
+    def watch(self, path: str, interval: float = 1.0):
+        # the file holds the rate in bytes/s, empty or 0 lifts the cap, it is reread whenever it changes
+        # or right away when wake is set (SIGUSR1 from the command line)
+        if path in self.watching:
+            return
+        self.watching.add(path)
+        def run():
+            mtime = None
+            while True:
+                try:
+                    stat = os.stat(path).st_mtime_ns
+                except OSError:
+                    stat = None
+                if stat is not None and stat != mtime:
+                    try:
+                        with open(path, 'r') as infile:
+                            text = infile.read().strip()
+                        self.set_rate(int(text) if text else None)
+                    except (OSError, ValueError) as err:
+                        print("Rate file", path, err)
+                mtime = stat
+                if self.wake.wait(interval):
+                    self.wake.clear()
+                    mtime = None
+        threading.Thread(target = run, daemon = True).start()
+
+BANDWIDTH = TokenBucket()
+
+class HttpPool:
+    # idle keep-alive http.client connections per host, shared by every worker so a file costs a request
+    # instead of a tcp (and tls) handshake, at most limit connections per host are open at once
+    def __init__(self, limit: int = 32):
+        self.limit = limit
+        self.lock = threading.Lock()
+        self.hosts = {}
+
+    def host(self, scheme: str, netloc: str):
+        with self.lock:
+            if (scheme, netloc) not in self.hosts:
+                self.hosts[(scheme, netloc)] = (threading.BoundedSemaphore(self.limit), [])
+            return self.hosts[(scheme, netloc)]
+
+    def connect(self, scheme: str, netloc: str) -> http.client.HTTPConnection:
+        if scheme == 'https':
+            return http.client.HTTPSConnection(netloc)
+        return http.client.HTTPConnection(netloc)
+
+    def close(self):
+        with self.lock:
+            for slots, idle in self.hosts.values():
+                for connection in idle:
+                    connection.close()
+                idle.clear()
+
+    @contextmanager
+    def open(self, url: str, headers: Dict[str, str] = {}, redirects: int = MAX_REDIRECTS):
+        parts = urllib.parse.urlsplit(url)
+        target = f'{parts.path}?{parts.query}' if parts.query else parts.path
+        slots, idle = self.host(parts.scheme, parts.netloc)
+        with slots:
+            while True:
+                with self.lock:
+                    connection = idle.pop() if idle else None
+                reused = connection is not None
+                connection = connection or self.connect(parts.scheme, parts.netloc)
+                try:
+                    connection.request('GET', target, headers = headers)
+                    response = connection.getresponse()
+                    break
+                except (http.client.HTTPException, OSError):
+                    connection.close()
+                    # a reused connection may have been closed by the server while idle, retry on another,
+                    # a fresh one failing is a real error
+                    if not reused:
+                        raise
+            location = None
+            try:
+                if response.status in REDIRECT_CODES and response.getheader('Location'):
+                    # drained so the connection can serve the next request, followed once the slot is free
+                    response.read()
+                    location = urllib.parse.urljoin(url, response.getheader('Location'))
+                elif not response.status in (200, 206):
+                    raise urllib.error.HTTPError(url, response.status, response.reason, response.headers, None)
+                else:
+                    yield response
+            finally:
+                # only a fully read response leaves the connection ready for the next request
+                if response.isclosed() and not response.will_close:
+                    with self.lock:
+                        idle.append(connection)
+                else:
+                    connection.close()
+        if location is not None:
+            if not redirects:
+                raise urllib.error.HTTPError(url, response.status, 'too many redirects', response.headers, None)
+            with self.open(location, headers, redirects - 1) as response:
+                yield response
+
+class AsyncHttpPool:
+    # asyncio counterpart of HttpPool speaking just enough http/1.1 for the cdn, so thousands of requests
+    # can be in flight from a single thread
+    def __init__(self, limit: int = 32):
+        self.limit = limit
+        self.hosts = {}
+
+    async def connect(self, scheme: str, netloc: str):
+        parts = urllib.parse.urlsplit(f'{scheme}://{netloc}')
+        port = parts.port or (443 if scheme == 'https' else 80)
+        return await asyncio.open_connection(parts.hostname, port, ssl = ssl.create_default_context() if scheme == 'https' else None)
+
+    @staticmethod
+    async def read_head(reader: asyncio.StreamReader):
+        line = await reader.readline()
+        if not line:
+            raise ConnectionResetError('connection closed by server')
+        version, status, *reason = line.decode('latin-1').rstrip('\r\n').split(' ', 2)
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            key, _, value = line.decode('latin-1').partition(':')
+            headers[key.strip().lower()] = value.strip()
+        return version, int(status), ' '.join(reason), headers
+
+    @staticmethod
+    async def read_body(reader: asyncio.StreamReader, headers: Dict[str, str], on_chunk) -> bool:
+        # returns whether the connection can be reused
+        async def read_exactly(remaining: int):
+            while remaining:
+                chunk = await reader.read(min(remaining, CHUNK_SIZE))
+                if not chunk:
+                    raise http.client.IncompleteRead(b'', remaining)
+                remaining -= len(chunk)
+                await asyncio.sleep(BANDWIDTH.delay(len(chunk)))
+                await on_chunk(chunk)
+        if 'chunked' in headers.get('transfer-encoding', '').lower():
+            while True:
+                size = int((await reader.readline()).split(b';')[0], 16)
+                if not size:
+                    while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+                        pass
+                    return True
+                await read_exactly(size)
+                await reader.readline()
+        if 'content-length' in headers:
+            await read_exactly(int(headers['content-length']))
+            return True
+        while True:
+            chunk = await reader.read(CHUNK_SIZE)
+            if not chunk:
+                return False
+            await asyncio.sleep(BANDWIDTH.delay(len(chunk)))
+            await on_chunk(chunk)
+
+    def close(self):
+        for slots, idle in self.hosts.values():
+            for reader, writer in idle:
+                writer.close()
+            idle.clear()
+
+    @staticmethod
+    async def discard(chunk: bytes):
+        pass
+
+    async def fetch(self, url: str, on_chunk, headers: Dict[str, str] = {}, redirects: int = MAX_REDIRECTS) -> Tuple[int, Dict[str, str]]:
+        # GETs url and awaits on_chunk for every piece of the body, returns the status and headers
+        parts = urllib.parse.urlsplit(url)
+        target = f'{parts.path}?{parts.query}' if parts.query else parts.path
+        if (parts.scheme, parts.netloc) not in self.hosts:
+            self.hosts[(parts.scheme, parts.netloc)] = (asyncio.Semaphore(self.limit), [])
+        slots, idle = self.hosts[(parts.scheme, parts.netloc)]
+        request = f'GET {target} HTTP/1.1\r\nHost: {parts.netloc}\r\nAccept-Encoding: identity\r\n'
+        request += ''.join(f'{key}: {value}\r\n' for key, value in headers.items()) + '\r\n'
+        async with slots:
+            while True:
+                reused = bool(idle)
+                reader, writer = idle.pop() if idle else await self.connect(parts.scheme, parts.netloc)
+                try:
+                    writer.write(request.encode('latin-1'))
+                    await writer.drain()
+                    version, status, reason, response_headers = await self.read_head(reader)
+                    break
+                except (ConnectionError, OSError):
+                    writer.close()
+                    # a reused connection may have been closed by the server while idle, retry on another,
+                    # a fresh one failing is a real error
+                    if not reused:
+                        raise
+            keep = False
+            redirect = status in REDIRECT_CODES and 'location' in response_headers
+            try:
+                if not redirect and not status in (200, 206):
+                    raise urllib.error.HTTPError(url, status, reason, response_headers, None)
+                # a redirect body is drained so the connection can serve the next request
+                keep = await self.read_body(reader, response_headers, self.discard if redirect else on_chunk)
+                keep = keep and version == 'HTTP/1.1' and response_headers.get('connection', '').lower() != 'close'
+                if not redirect:
+                    return status, response_headers
+            finally:
+                if keep:
+                    idle.append((reader, writer))
+                else:
+                    writer.close()
+        # followed once the slot is free again
+        if not redirects:
+            raise urllib.error.HTTPError(url, status, 'too many redirects', response_headers, None)
+        return await self.fetch(urllib.parse.urljoin(url, response_headers['location']), on_chunk, headers, redirects - 1)
+
+def http_open(url: str, pool: HttpPool = None, headers: Dict[str, str] = {}):
+    if pool is None:
+        return urllib.request.urlopen(urllib.request.Request(url, headers = headers))
+    return pool.open(url, headers)
+
+class RangeIgnored(Exception):
+    pass
+
+def range_check(url: str, response, offset: int):
+    # a 206 for some other range must never be appended where offset was asked for
+    content_range = response.headers.get('Content-Range', '')
+    if not content_range.startswith(f'bytes {offset}-'):
+        raise http.client.HTTPException(f'{url} answered range {content_range!r}, expected offset {offset}')
+
+def http_read_split(url: str, pool: HttpPool, offset: int, size: int):
+    # fetches [offset, size) as SPLIT_SEGMENT sized ranges over SPLIT_WAYS pooled connections at once and
+    # yields them in order, the next range is only started once the consumer asks for more, so at most
+    # SPLIT_WAYS segments are in flight plus the one the consumer still holds
+    def fetch(start: int) -> bytearray:
+        end = min(start + SPLIT_SEGMENT, size)
+        # read straight into the segment, joining chunks would briefly hold it twice
+        data = bytearray(end - start)
+        received = 0
+        with pool.open(url, { 'Range': f'bytes={start}-{end - 1}' }) as response, memoryview(data) as view:
+            if not response.status == 206:
+                raise RangeIgnored(url)
+            range_check(url, response, start)
+            while received < len(data):
+                read = response.readinto(view[received:received + CHUNK_SIZE])
+                if not read:
+                    break
+                BANDWIDTH.take(read)
+                received += read
+        if not received == len(data):
+            raise http.client.IncompleteRead(bytes(data[:received]), len(data) - received)
+        return data
+    starts = iter(range(offset, size, SPLIT_SEGMENT))
+    with ThreadPoolExecutor(SPLIT_WAYS) as executor:
+        window = deque(executor.submit(fetch, start) for start in islice(starts, SPLIT_WAYS))
+        try:
+            while window:
+                yield window.popleft().result()
+                window.extend(executor.submit(fetch, start) for start in islice(starts, 1))
+        finally:
+            for future in window:
+                future.cancel()
+
+def http_read(url: str, pool: HttpPool = None, offset: int = 0, size: int = None, split_size: int = SPLIT_SIZE):
+    # yields the body of url from offset on, a None first means the server ignored the range and the
+    # chunks that follow start over from byte zero
+    if pool is not None and size is not None and split_size and size - offset >= split_size:
+        split = http_read_split(url, pool, offset, size)
+        try:
+            first = next(split)
+        except RangeIgnored:
+            split = None
+        if split is not None:
+            yield first
+            yield from split
+            return
+    with http_open(url, pool, { 'Range': f'bytes={offset}-' } if offset else {}) as response:
+        if offset and not response.status == 206:
+            yield None
+        elif offset:
+            range_check(url, response, offset)
+        yield from BANDWIDTH.limit(iter(lambda: response.read(CHUNK_SIZE), b""))
+
+class OutputScan:
+    # one os.scandir pass over the output folder, so the verify and download planners find missing and
+    # wrong size files from memory instead of probing every manifest path with its own syscalls
+    def __init__(self, out: str):
+        self.out = out
+        self.entries = {}
+        self.casefold = set()
+        self.folders = set()
+        pending = [ '' ]
+        while pending:
+            folder = pending.pop()
+            try:
+                with os.scandir(f'{out}{folder}/') as entries:
+                    for entry in entries:
+                        name = f'{folder}/{entry.name}'
+                        if entry.is_dir():
+                            pending.append(name)
+                            self.folders.add(name)
+                        elif entry.is_file():
+                            self.entries[name] = entry
+                            self.casefold.add(name.casefold())
+            except OSError:
+                continue
+
+    def stat(self, name: str) -> Optional[os.stat_result]:
+        # free on windows, one cached stat per file that actually exists elsewhere
+        entry = self.entries.get(name)
+        try:
+            if entry is not None:
+                return entry.stat()
+            if name.casefold() in self.casefold:
+                # only exists under a different case, which is the same file on case insensitive systems
+                return os.stat(f'{self.out}{name}')
+        except OSError:
+            pass
+        return None
+
+def make_folders(out: str, folders: List[str]):
+    # one mkdir per folder of a ManBase.folder_plan, done before any download so workers never create folders
+    os.makedirs(out, exist_ok = True)
+    for folder in folders:
+        try:
+            os.mkdir(f'{out}{folder}')
+        except FileExistsError:
+            pass
+
+def file_allocate(outfile, size: int):
+    # reserves the final size up front so the file system can lay the file out in one piece, where
+    # posix_fallocate exists and the file system supports it
+    if size and hasattr(os, 'posix_fallocate'):
+        try:
+            os.posix_fallocate(outfile.fileno(), 0, size)
+        except OSError:
+            pass
+
+class VerifyState:
+    # sidecar in the output folder remembering which md5 each file was last verified against, together
+    # with its stat signature, a file whose signature did not change since does not need hashing again
+    def __init__(self, path: str, entries: Dict[str, list] = None):
+        self.path = path
+        self.entries = entries if entries is not None else {}
+        self.lock = threading.Lock()
+        self.dirty = False
+
+    @staticmethod
+    def signature(stat: os.stat_result) -> list:
+        return [ stat.st_size, stat.st_mtime_ns, stat.st_ino ]
+
+    def check(self, name: str, stat: os.stat_result, md5_hex: str) -> bool:
+        entry = self.entries.get(name)
+        if entry is None or not entry[0] == md5_hex:
+            return False
+        md5_hex, size, mtime_ns, inode = entry
+        # scandir reports inode 0 on windows, so a zero on either side only skips the inode comparison
+        return size == stat.st_size and mtime_ns == stat.st_mtime_ns and (not inode or not stat.st_ino or inode == stat.st_ino)
+
+    def record(self, name: str, stat: os.stat_result, md5_hex: str):
+        with self.lock:
+            self.entries[name] = [ md5_hex, *self.signature(stat) ]
+            self.dirty = True
+
+    def move(self, name: str, new_name: str):
+        # a renamed file keeps its stat signature, so it stays verified under its new name
+        with self.lock:
+            entry = self.entries.pop(name, None)
+            if entry is not None:
+                self.entries[new_name] = entry
+                self.dirty = True
+
+    def forget(self, name: str):
+        with self.lock:
+            if self.entries.pop(name, None) is not None:
+                self.dirty = True
+
+    def save(self):
+        with self.lock:
+            if not self.dirty:
+                return
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok = True)
+            with open(f'{self.path}.tmp', 'w', encoding = 'utf-8') as outfile:
+                json.dump({ 'version': 1, 'files': self.entries }, outfile, separators = (',', ':'))
+            os.replace(f'{self.path}.tmp', self.path)
+            self.dirty = False
+
+    @staticmethod
+    def load(out: str) -> 'VerifyState':
+        path = os.path.join(out, STATE_FILE)
+        try:
+            with open(path, 'r', encoding = 'utf-8') as infile:
+                data = json.load(infile)
+            if data.get('version') == 1:
+                return VerifyState(path, data['files'])
+        except (OSError, ValueError, KeyError, AttributeError):
+            pass
+        return VerifyState(path)
+
+def manifest_load(cdn: str, project: str, version: str, cache: str = None) -> ManBase:
+    # releases never change, so a manifest is fetched once per (cdn, project, version) and reopened
+    # from the compiled cache after that, falling back to the raw RLSM when the cache is unusable
+    url = f'{cdn}/projects/{project}/releases/{version}/releasemanifest'
+    if not cache:
+        print(f"Fetching manifest {url}")
+        with urllib.request.urlopen(url) as response:
+            return ManColumns.read(response)
+    key = hashlib.sha1(f'{cdn}\0{project}\0{version}'.encode('utf-8')).hexdigest()
+    raw_path = os.path.join(cache, f'{key}.rlsm')
+    compiled_path = os.path.join(cache, f'{key}.rlsc')
+    try:
+        man = ManColumns.load(compiled_path)
+        print(f"Using cached manifest {url}")
+        return man
+    except (OSError, ValueError, struct.error):
+        pass
+    try:
+        if os.path.exists(raw_path):
+            with open(raw_path, 'rb') as infile:
+                man = ManColumns.parse(infile.read())
+        else:
+            print(f"Fetching manifest {url}")
+            os.makedirs(cache, exist_ok = True)
+            with urllib.request.urlopen(url) as response, open(f'{raw_path}.tmp', 'wb') as outfile:
+                man = ManColumns.read(response, tee = outfile)
+            os.replace(f'{raw_path}.tmp', raw_path)
+    except urllib.error.URLError:
+        raise
+    except OSError as err:
+        # an unusable cache folder only costs the cache, the manifest is streamed again without it
+        print(f"Manifest cache unusable: {err}")
+        return manifest_load(cdn, project, version)
+    try:
+        man.save(compiled_path)
+    except OSError:
+        pass
+    return man
+
+class AdaptiveLimit:
+    # aimd over the number of in flight downloads: one more slot per window while throughput keeps up,
+    # halve on errors, back off by a quarter when throughput drops while latency climbs
+    def __init__(self, low: int, high: int, window: float = ADAPTIVE_WINDOW, error_rate: float = 0.05):
+        self.low = max(1, low)
+        self.high = max(self.low, high)
+        self.limit = self.low
+        self.window = window
+        self.error_rate = error_rate
+        self.active = 0
+        self.saturated = False
+        self.cond = threading.Condition()
+        self.history = [ (time.monotonic(), self.limit) ]
+        self.last_rate = None
+        self.last_latency = None
+        self.reset(time.monotonic())
+
+    def reset(self, now: float):
+        self.window_start = now
+        self.window_bytes = 0
+        self.window_latency = 0.0
+        self.window_count = 0
+        self.window_errors = 0
+
+    def acquire(self):
+        with self.cond:
+            while self.active >= self.limit:
+                self.cond.wait()
+            self.active += 1
+            self.saturated = self.saturated or self.active >= self.limit
+
+    def run(self, size: int, download, *args):
+        # download returns (path, error) like ManBase.file_download
+        self.acquire()
+        start = time.monotonic()
+        path, error = None, True
+        try:
+            path, error = download(*args)
+        finally:
+            self.release(size, time.monotonic() - start, error)
+        return path, error
+
+    def release(self, size: int, latency: float, error):
+        with self.cond:
+            self.active -= 1
+            self.window_count += 1
+            self.window_latency += latency
+            if error:
+                self.window_errors += 1
+            else:
+                self.window_bytes += size
+            now = time.monotonic()
+            if now - self.window_start >= self.window:
+                self.adjust(now)
+            self.cond.notify_all()
+
+    def adjust(self, now: float):
+        rate = self.window_bytes / (now - self.window_start)
+        latency = self.window_latency / self.window_count
+        limit = self.limit
+        if self.window_errors > self.window_count * self.error_rate:
+            limit = limit // 2
+        elif self.last_rate is not None and rate < self.last_rate * 0.9 and latency > self.last_latency * 1.5:
+            limit = limit * 3 // 4
+        elif self.saturated:
+            # only grow when the current limit was actually the bottleneck
+            limit = limit + 1
+        limit = min(self.high, max(self.low, limit))
+        if limit != self.limit:
+            self.limit = limit
+            self.history.append((now, limit))
+        self.last_rate = rate
+        self.last_latency = latency
+        self.saturated = self.active >= self.limit
+        self.reset(now)
+
+class MemoryBudget:
+    # byte semaphore, a download is admitted only once its memory fits in what is left of the budget,
+    # one bigger than the whole budget waits until it can run alone
+    def __init__(self, budget: int):
+        self.budget = budget
+        self.free = budget
+        self.cond = threading.Condition()
+
+    def acquire(self, size: int) -> int:
+        size = min(size, self.budget)
+        with self.cond:
+            while self.free < size:
+                self.cond.wait()
+            self.free -= size
+        return size
+
+    def release(self, size: int):
+        with self.cond:
+            self.free += size
+            self.cond.notify_all()
+
+    def run(self, size: int, download, *args):
+        size = self.acquire(size)
+        try:
+            return download(*args)
+        finally:
+            self.release(size)
+
+class Durability:
+    # when committed files reach the disk: 'none' leaves it to the os, 'file' fsyncs every file before its
+    # rename and the folder after it, 'batch' fsyncs the files and folders of every batch renames together
+    def __init__(self, mode: str = 'none', batch: int = FSYNC_BATCH):
+        self.mode = mode
+        self.batch = batch
+        self.pending = []
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def sync_folder(path: str):
+        # folders can only be opened and fsynced on posix
+        if os.name == 'posix':
+            fd = os.open(path, os.O_RDONLY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+
+    def written(self, outfile):
+        if self.mode == 'file':
+            os.fsync(outfile.fileno())
+
+    def renamed(self, path: str):
+        if self.mode == 'file':
+            self.sync_folder(os.path.dirname(path))
+        elif self.mode == 'batch':
+            with self.lock:
+                self.pending.append(path)
+                if len(self.pending) < self.batch:
+                    return
+                pending, self.pending = self.pending, []
+            self.sync(pending)
+
+    def sync(self, paths: List[str]):
+        for path in paths:
+            # FlushFileBuffers on windows needs a handle with write access
+            with open(path, 'r+b') as outfile:
+                os.fsync(outfile.fileno())
+        for folder in set(os.path.dirname(path) for path in paths):
+            self.sync_folder(folder)
+
+    def close(self):
+        with self.lock:
+            pending, self.pending = self.pending, []
+        self.sync(pending)
+
+class ContentStore:
+    # files shared between releases, kept once under their md5 and linked into every release folder, a
+    # download that finds its md5 here never touches the network
+    def __init__(self, root: str, link: str = 'hardlink'):
+        self.root = root
+        self.link = link
+        self.lock = threading.Lock()
+        self.locks = {}
+        self.temps = iter(range(0, 1 << 62))
+        for prefix in range(0, 256):
+            os.makedirs(f'{root}/{prefix:02x}', exist_ok = True)
+
+    def path(self, md5_hex: str) -> str:
+        return f'{self.root}/{md5_hex[:2]}/{md5_hex}'
+
+    def temp(self, md5_hex: str) -> str:
+        # unique per download, other processes may be filling the same store
+        return f'{self.path(md5_hex)}.{os.getpid()}.{next(self.temps)}.tmp'
+
+    def has(self, md5_hex: str, size: int, path: str = None) -> bool:
+        # hardlinks share edits made in place through any release, so an entry is hashed before it is
+        # reused and dropped to be downloaded again when it no longer matches, path is the release file
+        # being replaced, when that failed verification while linked to the entry the hash is skipped
+        source = self.path(md5_hex)
+        try:
+            stat = os.stat(source)
+            if path is not None and os.path.exists(path) and os.path.samestat(stat, os.stat(path)):
+                os.remove(source)
+                return False
+            if not stat.st_size == size:
+                return False
+            hash_md5 = hashlib.md5()
+            with open(source, 'rb') as infile:
+                for chunk in iter(lambda: infile.read(CHUNK_SIZE), b""):
+                    hash_md5.update(chunk)
+            if not hash_md5.hexdigest() == md5_hex:
+                os.remove(source)
+                return False
+            return True
+        except OSError:
+            return False
+
+    @contextmanager
+    def locked(self, md5_hex: str):
+        with self.lock:
+            lock = self.locks.setdefault(md5_hex, threading.Lock())
+        with lock:
+            yield
+
+    def materialize(self, md5_hex: str, path: str, durability: Durability = None) -> os.stat_result:
+        # linked under a temp name first so a wrong file already at path is replaced in one step, copied
+        # when the link is not possible (another device, no reflink support)
+        source = self.path(md5_hex)
+        temp = f'{path}.tmp'
+        if os.path.lexists(temp):
+            os.remove(temp)
+        try:
+            if self.link == 'reflink':
+                if fcntl is None:
+                    raise OSError('reflink is not supported here')
+                with open(source, 'rb') as infile, open(temp, 'wb') as outfile:
+                    fcntl.ioctl(outfile.fileno(), FICLONE, infile.fileno())
+            else:
+                os.link(source, temp)
+        except OSError:
+            shutil.copyfile(source, temp)
+        os.replace(temp, path)
+        if durability is not None:
+            durability.renamed(path)
+        return os.stat(path)
+
+class FileQueue:
+    # bounded queue of file indices between the verify and download stages, largest file first when given
+    # the manifest (longest processing time first, so the giants never become the tail), first in first
+    # out without, get returns None once closed and drained
+    def __init__(self, man: ManBase = None, maxsize: int = 0, file_indices = None):
+        self.man = man
+        self.queue = queue.PriorityQueue(maxsize)
+        self.order = iter(range(0, 1 << 62))
+        if file_indices is not None:
+            for file_index in file_indices:
+                self.put(file_index)
+            self.close()
+
+    def put(self, file_index: int):
+        size = self.man.file_size_compressed(file_index) if self.man is not None else 0
+        self.queue.put((-size, next(self.order), file_index))
+
+    def close(self):
+        self.queue.put((1, 0, None))
+
+    def get(self) -> Optional[int]:
+        item = self.queue.get()
+        if item[2] is None:
+            # leave the end marker for the other consumers
+            self.queue.put(item)
+        return item[2]
+
+def imap_lanes(func, lanes):
+    # lanes: (threads, FileQueue) pairs, each lane has its own workers so items of one lane never wait
+    # behind another's, results of every lane are yielded as they finish
+    results = queue.Queue()
+    stop = threading.Event()
+    def worker(items: FileQueue):
+        try:
+            for item in iter(items.get, None):
+                if stop.is_set():
+                    break
+                try:
+                    results.put(func(item))
+                except Exception as err:
+                    results.put((None, err))
+        finally:
+            results.put(None)
+    workers = 0
+    for threads, items in lanes:
+        for _ in range(0, threads):
+            threading.Thread(target = worker, args = (items,), daemon = True).start()
+            workers += 1
+    try:
+        while workers:
+            result = results.get()
+            if result is None:
+                workers -= 1
+            else:
+                yield result
+    finally:
+        stop.set()
+
+def download_async(man: ManBase, cdn: str, output: str, file_indices: FileQueue, concurrency: int, retries: int,
+                   state: VerifyState, io_threads: int = IO_THREADS, durability: Durability = None, preallocate: bool = False,
+                   store: ContentStore = None):
+    # runs the asyncio engine on its own thread and hands its (path, error) results back through a queue,
+    # so callers consume the same stream the thread pool engine produces
+    results = queue.Queue()
+    async def engine():
+        loop = asyncio.get_running_loop()
+        pool = AsyncHttpPool(concurrency)
+        with ThreadPoolExecutor(io_threads) as executor, ThreadPoolExecutor(1) as waiter:
+            async def worker():
+                while True:
+                    # the queue blocks while verification is still looking for files, so wait for it off the loop
+                    file_index = await loop.run_in_executor(waiter, file_indices.get)
+                    if file_index is None:
+                        return
+                    results.put(await man.file_download_async(file_index, cdn, output, retries, state, pool, executor, durability,
+                                                                 preallocate, store))
+            try:
+                await asyncio.gather(*[ worker() for _ in range(0, concurrency) ])
+            finally:
+                pool.close()
+    def run():
+        try:
+            asyncio.run(engine())
+        except Exception as err:
+            # handed to the consumer, a failed engine must not look like one that had nothing to do
+            results.put(err)
+        finally:
+            results.put(None)
+    threading.Thread(target = run, daemon = True).start()
+    for result in iter(results.get, None):
+        if isinstance(result, Exception):
+            raise result
+        yield result
+
+def version_pad(version: str) -> str:
     # left pad version with 0's to match a.b.c.d
     version = [ str(int(x)) for x in version.split('.') ]
     version = [ "0" ] * (4 - len(version)) + version
-    version = '.'.join(version)
-    url = f'{cdn}/projects/{project}/releases/{version}/releasemanifest'
-    print(f"Fetching manifest {url}")
-    man_data = urllib.request.urlopen(url).read()
-    man = Man.read(io.BytesIO(man_data))
-    print(f"Verifying {man.file_count()} files")
-    missing_files = [ file_index for file_index in man.file_range() if not man.file_verify(file_index, output) ]
-    print(f"Fetching {len(missing_files)} files")
-    fetch = lambda file_index: man.file_download(file_index, cdn, output)
-    results = ThreadPool(threads).imap_unordered(fetch, missing_files)
-    count = 0
-    for path, error in results:
-        count += 1
-        if not error:
-            print(count, "Done", path)
+    return '.'.join(version)
+
+def fetch_files(man: ManBase, cdn: str, output: str, state: VerifyState, file_indices, threads: int = 32, retries = 3,
+                engine: str = 'threads', io_threads: int = IO_THREADS, resume_size: int = RESUME_SIZE,
+                split_size: int = SPLIT_SIZE, schedule: str = 'largest', small_threads: int = 0, small_size: int = SMALL_SIZE,
+                min_threads: int = None, rate_limit: int = None, rate_file: str = None, memory_budget: int = None,
+                fsync: str = 'none', fsync_batch: int = FSYNC_BATCH, preallocate: bool = False, store: str = None,
+                store_link: str = 'hardlink'):
+    # the download stage shared by download and patch_release, file_indices is consumed on its own thread
+    # and feeds the engine as it goes, so fetching starts with the first file found missing
+    # the cap is process wide, it also holds back any other download running alongside this one
+    if rate_limit is not None:
+        BANDWIDTH.set_rate(rate_limit)
+    if rate_file is not None:
+        BANDWIDTH.watch(rate_file)
+    pool = None
+    limit = None
+    durability = Durability(fsync, fsync_batch)
+    content = ContentStore(store, store_link) if store is not None else None
+    try:
+        large = FileQueue(man if schedule == 'largest' else None, PIPELINE_SIZE)
+        small = FileQueue(man if schedule == 'largest' else None, PIPELINE_SIZE) if small_threads and engine != 'asyncio' else large
+        errors = []
+        def find_stage():
+            missing = 0
+            try:
+                for file_index in file_indices:
+                    # optionally small files get their own lane so they never wait behind the giants
+                    (small if man.file_size_compressed(file_index) < small_size else large).put(file_index)
+                    missing += 1
+                print(f"Verified, fetching {missing} files")
+            except Exception as err:
+                errors.append(err)
+            finally:
+                large.close()
+                small.close()
+        threading.Thread(target = find_stage, daemon = True).start()
+        if engine == 'asyncio':
+            results = download_async(man, cdn, output, large, threads, retries, state, io_threads, durability, preallocate,
+                                     content)
         else:
-            print(count, "Error", path, error)
+            pool = HttpPool(threads + small_threads)
+            fetch = lambda file_index: man.file_download(file_index, cdn, output, retries, state, pool, resume_size, split_size,
+                                                            durability, preallocate, content)
+            if memory_budget is not None:
+                budget = MemoryBudget(memory_budget)
+                download_file = fetch
+                fetch = lambda file_index: budget.run(man.file_memory(file_index, split_size), download_file, file_index)
+            if min_threads is not None and min_threads < threads:
+                # threads becomes the upper bound, the controller decides how many of them fetch at once
+                limit = AdaptiveLimit(min_threads, threads)
+                download_one = fetch
+                fetch = lambda file_index: limit.run(man.file_size_compressed(file_index), download_one, file_index)
+            results = imap_lanes(fetch, [ (threads, large), (small_threads, small) ] if small is not large else [ (threads, large) ])
+        count = 0
+        shown = None
+        for path, error in results:
+            count += 1
+            if limit is not None and limit.limit != shown:
+                shown = limit.limit
+                print(count, "Concurrency", shown)
+            if not error:
+                print(count, "Done", path)
+            else:
+                print(count, "Error", path, error)
+        if errors:
+            raise errors[0]
+    finally:
+        if pool is not None:
+            pool.close()
+        durability.close()
+
+def download(cdn: str, project: str, version: str, output: str, threads: int = 32, retries = 3, cache: str = None,
+             verify_threads: int = VERIFY_THREADS, deep: bool = False, **options):
+    # options are the download stage settings of fetch_files
+    version = version_pad(version)
+    man = manifest_load(cdn, project, version, cache)
+    print(f"Verifying {man.file_count()} files")
+    state = VerifyState.load(output)
+    scan = OutputScan(output)
+    make_folders(output, man.folder_plan(scan))
+    try:
+        # everything the scan settles is known at once, fed in schedule order ahead of the bounded queue, so
+        # the largest files still start first when far more than PIPELINE_SIZE of them are missing
+        missing, matching = man.scan_split(scan)
+        if options.get('schedule', 'largest') == 'largest':
+            missing.sort(key = man.file_size_compressed, reverse = True)
+        hashed = (file_index for file_index, ok in man.verify(output, verify_threads, matching, state, deep, scan) if not ok)
+        fetch_files(man, cdn, output, state, chain(missing, hashed), threads, retries, **options)
+    finally:
+        state.save()
+
+def file_relocate(old: ManBase, new: ManBase, diff: ManDiff, output: str, state: VerifyState) -> List[int]:
+    # moves content of the old release to its new paths before anything is downloaded, the last new path
+    # of a removed file gets it by rename and every other one a copy, returns the new files relocated
+    targets = {}
+    for old_index, new_index in diff.moved:
+        targets.setdefault(old_index, []).append(new_index)
+    removed = set(diff.removed)
+    relocated = []
+    for old_index, new_indices in targets.items():
+        name = old.file_path(old_index)
+        source = f'{output}{name}'
+        for new_index in new_indices:
+            new_name = new.file_path(new_index)
+            path = f'{output}{new_name}'
+            try:
+                if old_index in removed and new_index == new_indices[-1]:
+                    os.replace(source, path)
+                    state.move(name, new_name)
+                else:
+                    shutil.copyfile(source, f'{path}.tmp')
+                    os.replace(f'{path}.tmp', path)
+            except OSError:
+                # not there or unreadable, it is fetched like any other missing file
+                pass
+            relocated.append(new_index)
+    return relocated
+
+def patch_release(cdn: str, project: str, old_version: str, new_version: str, output: str, threads: int = 32, retries = 3,
+                  cache: str = None, verify_threads: int = VERIFY_THREADS, deep: bool = False, delete: bool = False,
+                  **options):
+    # updates an install of old_version in output to new_version from the difference of both manifests,
+    # unchanged files are left alone without being verified, options are the download stage settings of fetch_files
+    old = manifest_load(cdn, project, version_pad(old_version), cache)
+    new = manifest_load(cdn, project, version_pad(new_version), cache)
+    diff = ManDiff.build(old, new)
+    print(f"Unchanged {len(diff.unchanged)}, moved {len(diff.moved)}, changed {len(diff.changed)}, added {len(diff.added)}"
+          f", removed {len(diff.removed)} files")
+    state = VerifyState.load(output)
+    make_folders(output, new.folder_plan())
+    try:
+        # relocated first, copies may be taken from changed files that are overwritten below
+        relocated = file_relocate(old, new, diff, output, state)
+        if delete:
+            for file_index in diff.removed:
+                name = old.file_path(file_index)
+                # a case only rename on a case insensitive system resolves to the new file and holds its content now
+                renamed = new.file_path_index_casefold.get(name.casefold())
+                if renamed is not None:
+                    renamed = f'{output}{new.file_path(renamed)}'
+                    if os.path.exists(renamed) and os.path.exists(f'{output}{name}') and os.path.samefile(f'{output}{name}', renamed):
+                        continue
+                if os.path.exists(f'{output}{name}'):
+                    os.remove(f'{output}{name}')
+                state.forget(name)
+        def missing():
+            yield from (file_index for _, file_index in diff.changed)
+            yield from diff.added
+            # relocated files are the only ones read back, their content did not come through a checked download
+            yield from (file_index for file_index, ok in new.verify(output, verify_threads, relocated, state, deep) if not ok)
+        fetch_files(new, cdn, output, state, missing(), threads, retries, **options)
+    finally:
+        state.save()
 
 def select_list(name, selections, key):
     if len(selections) == 1:
@@ -233,7 +1873,7 @@ def get_folder():
     print('-' * 79)
     return folder.replace('"', '')
 
-def main(versions):
+def main(versions, options):
     realm = select_list('realm', versions, 'realm')
     patch = select_list('patch', realm['patches'], 'version')
     game_release = select_list('game release', patch['releases'], 'version')
@@ -246,15 +1886,25 @@ def main(versions):
     print(f"Locale: {locale['name']}")
     print(f"Locale release: {locale_release['version']}")
     print(f"Output folder: {folder}")
+    options = vars(options)
+    patch_from = options.pop('patch_from')
+    delete = options.pop('delete')
+    if patch_from is not None:
+        print(f"Patching from: {patch_from}")
     input("Enter to continue")
     while True:
-        print('-' * 79)
-        download(f"http://akacdn.riotgames.com/releases/{realm['realm']}", f"lol_game_client_{locale['name']}", game_release['version'], folder)
-        print('-' * 79)
-        download(f"http://akacdn.riotgames.com/releases/{realm['realm']}", f"lol_game_client", game_release['version'], folder)
+        for project in [ f"lol_game_client_{locale['name']}", "lol_game_client" ]:
+            print('-' * 79)
+            cdn = f"http://akacdn.riotgames.com/releases/{realm['realm']}"
+            if patch_from is not None:
+                patch_release(cdn, project, patch_from, game_release['version'], folder, cache = CACHE_DIR, delete = delete, **options)
+            else:
+                download(cdn, project, game_release['version'], folder, cache = CACHE_DIR, **options)
         print('-' * 79)
         print("All done!")
         input("Press enter to verify or re-download any missing files")
+        # later passes check the whole release again
+        patch_from = None
 
 versions = json.loads(bz2.decompress(base64.b64decode(b"""
 QlpoOTFBWSZTWdYnWb4FC0n7gERWRERUBX/wAAq//99aYKLfPgigEqiAwAeA8CgAABRQADQAaNAA
@@ -2403,4 +4053,31 @@ IADu7nAAAJBgzu5CCQQCAAVwgYSK5FQVVVBBVVBVVVVVVVVVBVVVUFVBVQBBVUFVVVVVVVVVVVVB
 VVQVQAUVUhBUWKqqxVVVBVRFVVWTMmMyZkhEE1UQA1EEBV/sAI9CKYD/uqgn/CiAH8CiAI/6gKio
 6aACJoCgBoKIAj/tqqgmoKpqogADqICP/Iu5IpwoSDxkSJkA
 """)))
-main(versions)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'Download old League of Legends releases.')
+    parser.add_argument('--threads', type = int, default = 32, help = 'concurrent file downloads')
+    parser.add_argument('--verify-threads', type = int, default = VERIFY_THREADS, help = 'concurrent file verifications')
+    parser.add_argument('--deep', action = 'store_true', help = 'rehash every file instead of trusting the verification state')
+    parser.add_argument('--engine', choices = [ 'threads', 'asyncio' ], default = 'threads', help = 'download engine, asyncio keeps --threads requests in flight from one thread')
+    parser.add_argument('--resume-size', type = int, default = RESUME_SIZE, help = 'keep partial downloads of files at least this many compressed bytes large')
+    parser.add_argument('--split-size', type = int, default = SPLIT_SIZE, help = 'fetch files at least this many compressed bytes large as parallel ranges, 0 to disable')
+    parser.add_argument('--min-threads', type = int, default = None, help = 'adapt the number of in flight downloads between this and --threads')
+    parser.add_argument('--rate-limit', type = int, default = None, help = 'cap all downloads together to this many bytes/s')
+    parser.add_argument('--rate-file', default = None, help = 'file holding the bytes/s cap, reread when it changes or on SIGUSR1')
+    parser.add_argument('--memory-budget', type = int, default = None, help = 'bytes of download buffers allowed in flight at once')
+    parser.add_argument('--fsync', choices = [ 'none', 'file', 'batch' ], default = 'none', help = 'when downloaded files are flushed to disk')
+    parser.add_argument('--fsync-batch', type = int, default = FSYNC_BATCH, help = 'files per fsync with --fsync batch')
+    parser.add_argument('--preallocate', action = 'store_true', help = 'posix_fallocate every file to its final size before writing')
+    parser.add_argument('--store', default = None, help = 'shared folder keeping every downloaded file once by md5, releases link to it')
+    parser.add_argument('--store-link', choices = [ 'hardlink', 'reflink' ], default = 'hardlink',
+                        help = 'how release files are linked to the store, hardlinks share edits made in place')
+    parser.add_argument('--patch-from', default = None, help = 'release installed in the output folder, only its differences are fetched')
+    parser.add_argument('--delete', action = 'store_true', help = 'with --patch-from, delete files the new release no longer has')
+    parser.add_argument('--schedule', choices = [ 'largest', 'manifest' ], default = 'largest', help = 'order in which missing files are fetched')
+    parser.add_argument('--small-threads', type = int, default = 0, help = 'extra threads only for files below --small-size')
+    parser.add_argument('--small-size', type = int, default = SMALL_SIZE, help = 'compressed size below which a file counts as small')
+    parser.add_argument('--io-threads', type = int, default = IO_THREADS, help = 'disk and decompression threads of the asyncio engine')
+    if hasattr(signal, 'SIGUSR1'):
+        signal.signal(signal.SIGUSR1, lambda signum, frame: BANDWIDTH.wake.set())
+    main(versions, parser.parse_args())